@@ -1,10 +1,13 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import glob
 import os
 import html
-import re
 import json
+import csv
+import bisect
+import hashlib
 import requests
 import threading
 import time
@@ -13,6 +16,10 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 import streamlit.components.v1 as components
 from datetime import datetime, timedelta
 from pandas.tseries.offsets import DateOffset
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 
 # 追加（オーバーレイ表示用）
 import base64
@@ -20,55 +27,262 @@ import io
 import matplotlib.pyplot as plt
 
 
+# ==========================
+# CSV → Parquet ディスクキャッシュ
+# ==========================
+# st.cache_data はプロセス内メモリのみなので、コンテナ再起動や新しいセッションの
+# 初回表示ではCSV（cp932）を全件パースし直すことになる。
+# 1ファイルごとにパース結果を .cache/ 配下にParquetで保存しておき、
+# (ファイル名, 更新日時, サイズ) が変わっていなければParquetから読み込む。
+# キャッシュは .cache/<namespace>/<CSVファイル名>.<キー>.parquet に置き、同じCSVの古いキャッシュは
+# 新しく書いたときに削除する。読み込み処理を変えて namespace を上げた場合、古い namespace の
+# フォルダは使われなくなるだけなので、.cache/ ごと（または古いフォルダを）削除してよい。
+CSV_CACHE_DIR = ".cache"
+
+
+def _parquet_cache_path(path, namespace):
+    stat = os.stat(path)
+    key = hashlib.sha1(f"{stat.st_mtime}|{stat.st_size}".encode("utf-8")).hexdigest()
+    return os.path.join(CSV_CACHE_DIR, namespace, f"{os.path.basename(path)}.{key}.parquet")
+
+
+def _remove_stale_cache_files(cache_path):
+    """cache_path と同じCSVの、更新日時・サイズが違う（＝もう使われない）キャッシュファイルを削除する。"""
+    cache_dir, cache_name = os.path.split(cache_path)
+    # "<CSVファイル名>.<sha1 40桁>.parquet" のうち、CSVファイル名が同じものだけを対象にする
+    prefix = cache_name[: -len(".parquet") - 40]
+    try:
+        with os.scandir(cache_dir) as it:
+            stale = [
+                e.path for e in it
+                if e.name != cache_name
+                and e.name.startswith(prefix)
+                and e.name.endswith(".parquet")
+                and len(e.name) == len(cache_name)
+            ]
+        for p in stale:
+            os.remove(p)
+    except OSError:
+        pass
+
+
+def read_table_cached(path, reader, namespace):
+    """
+    reader(path) の結果（pyarrow.Table）をParquetにキャッシュして返す。
+    キャッシュの読み書きに失敗した場合（書き込み不可の環境など）は、そのままCSVを読む。
+    """
+    try:
+        cache_path = _parquet_cache_path(path, namespace)
+    except OSError:
+        return reader(path)
+
+    if os.path.exists(cache_path):
+        try:
+            return pq.read_table(cache_path)
+        except Exception:
+            pass  # 壊れたキャッシュはCSVから作り直す
+
+    table = reader(path)
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # 複数セッションから同時に書かれても壊れないよう、一時ファイル経由で置き換える
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        pq.write_table(table, tmp_path, compression="zstd")
+        os.replace(tmp_path, cache_path)
+    except Exception:
+        pass
+    else:
+        _remove_stale_cache_files(cache_path)
+    return table
+
+
 # ==========================
 # Tempostar CSV 読み込み
 # ==========================
-@st.cache_data
-def load_tempostar_data(file_paths):
-    dfs = []
-    for path in file_paths:
-        df = pd.read_csv(path, encoding="cp932")
-        df["元ファイル"] = os.path.basename(path)
-        dfs.append(df)
+# 文字列として読む列（ファイルによって商品基本コードなどが数値と推定されるのを防ぐ）
+TEMPOSTAR_TEXT_COLUMNS = ["更新理由", "商品基本コード", "商品コード", "商品名", "属性1名", "属性2名"]
+
+# アプリで使う列。それ以外（更新日時・倉庫名・ユーザーなど）はパースもキャッシュもしない
+TEMPOSTAR_COLUMNS = TEMPOSTAR_TEXT_COLUMNS + ["変動後", "増減値"]
+
+# 読み込み結果の型を変えたら、古いParquetキャッシュを使わないようにバージョンを上げる
+TEMPOSTAR_CACHE_NAMESPACE = "tempostar_v4"
 
-    all_df = pd.concat(dfs, ignore_index=True)
 
-    # 数値列を明示的に変換
+def _read_tempostar_csv(path):
+    # PyArrowのCSVパーサはUTF-8のみ対応のため、cp932はメモリ上でUTF-8に変換してから渡す
+    with open(path, "rb") as f:
+        text = f.read().decode("cp932")
+
+    # ファイルに存在する列だけを指定する（無い列を指定するとエラーになるため、ヘッダ行を先に見る）
+    header = next(csv.reader(io.StringIO(text.split("\n", 1)[0])), [])
+    include = [col for col in TEMPOSTAR_COLUMNS if col in header]
+
+    table = pacsv.read_csv(
+        pa.BufferReader(text.encode("utf-8")),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=include,
+            column_types={col: pa.string() for col in TEMPOSTAR_TEXT_COLUMNS},
+            strings_can_be_null=True,  # pandas.read_csv と同じく空欄は欠損扱い
+        ),
+    )
+
+    # 数値列を明示的に変換（整数として読めていれば変換は不要）
     for col in ["増減値", "変動後"]:
-        if col in all_df.columns:
-            all_df[col] = (
-                pd.to_numeric(all_df[col], errors="coerce")
+        if col in table.column_names and not pa.types.is_integer(table.schema.field(col).type):
+            values = (
+                pd.to_numeric(table.column(col).to_pandas(), errors="coerce")
                 .fillna(0)
-                .astype(int)
+                .astype("int64")
             )
+            table = table.set_column(table.schema.get_field_index(col), col, pa.array(values))
+    return table
+
+
+def _load_tempostar_file(path):
+    table = read_table_cached(path, _read_tempostar_csv, TEMPOSTAR_CACHE_NAMESPACE)
+    # ファイル名は全行同じ値なので、文字列を行数分持たずに辞書型（pandas側ではカテゴリ）で付ける
+    source = pa.DictionaryArray.from_arrays(
+        pa.repeat(0, table.num_rows).cast(pa.int32()),
+        pa.array([os.path.basename(path)]),
+    )
+    return table.append_column("元ファイル", source)
+
+
+def tempostar_file_keys(file_paths):
+    """
+    キャッシュキー用に、各ファイルの (パス, 更新日時, サイズ) のタプルを返す。
+    CSVが同じ名前のまま差し替えられた場合もキーが変わり、キャッシュを使わずに読み直す。
+    """
+    return tuple(
+        (p, os.path.getmtime(p), os.path.getsize(p)) for p in file_paths
+    )
+
+
+def load_tempostar_data(file_paths):
+    """
+    Tempostar CSV（複数）を1つのDataFrameにまとめて返す。
+    結果はプロセス内で共有する（st.cache_resource）ので、呼び出し側では列の追加・書き換えをせず、
+    必要なら assign などで新しいDataFrameを作ること。
+    キャッシュキーには各ファイルの更新日時・サイズを含め、CSVが差し替えられたら読み直す。
+    """
+    return _load_tempostar_data(tempostar_file_keys(file_paths))
+
+
+@st.cache_resource(show_spinner="Tempostar CSV を読み込み中…")
+def _load_tempostar_data(file_keys):
+    # st.cache_data と違い、呼び出しのたびに数十万行のDataFrameを複製（pickle）しない
+    file_paths = [p for p, _, _ in file_keys]
+
+    # ファイルごとの読み込みは独立しているので、スレッドで並行して読む
+    with ThreadPoolExecutor(max_workers=min(8, max(len(file_paths), 1))) as executor:
+        tables = list(executor.map(_load_tempostar_file, file_paths))
+
+    # Arrowのまま連結（チャンクを並べるだけでコピーしない）し、pandasへの変換は最後に1回だけ行う
+    try:
+        all_df = pa.concat_tables(tables, promote_options="permissive").to_pandas()
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # 同じ列名でもファイルによって型が食い違う場合は、pandas側でobject型にまとめる
+        all_df = pd.concat([t.to_pandas() for t in tables], ignore_index=True)
+
+    # ファイルごとに列の有無が違う場合、concatで欠けた部分がNaNになるため再度埋める
+    # （在庫数・増減値はint32で十分なので、集計時に読むバイト数を半分にする）
+    for col in ["増減値", "変動後"]:
+        if col in all_df.columns:
+            all_df[col] = all_df[col].fillna(0).astype("int32")
+
+    # SKU正規化
+    if "商品コード" in all_df.columns:
+        all_df["商品コード"] = all_df["商品コード"].str.strip()
+
+    # 集計キー（商品コード）や「last」で集計する列は同じ文字列が何度も出てくるため、
+    # カテゴリ型にしてgroupbyが文字列ではなく整数コードでグループ化できるようにする
+    # （更新理由も「受注取込」など数種類しかないので、比較がカテゴリ単位で済む）
+    for col in ["商品コード", "商品基本コード", "商品名", "属性1名", "属性2名", "更新理由"]:
+        if col in all_df.columns:
+            all_df[col] = all_df[col].astype("category")
     return all_df
 
 
 # ==========================
 # 商品画像マスタ読み込み
 # ==========================
-@st.cache_data
+IMAGE_MASTER_COLUMNS = ["商品管理番号（商品URL）", "商品画像パス1"]
+
+
+def _read_image_master_csv(path):
+    # 使うのはキーと画像パスの2列だけなので、それ以外の列はパースしない
+    with open(path, "rb") as f:
+        raw = f.read().decode("cp932").encode("utf-8")
+    try:
+        return pacsv.read_csv(
+            pa.BufferReader(raw),
+            convert_options=pacsv.ConvertOptions(
+                include_columns=IMAGE_MASTER_COLUMNS,
+                column_types={col: pa.string() for col in IMAGE_MASTER_COLUMNS},
+                strings_can_be_null=True,
+            ),
+        )
+    except KeyError:
+        # 必要な列が無いファイルは空として扱う
+        return pa.table({col: pa.array([], pa.string()) for col in IMAGE_MASTER_COLUMNS})
+
+
+@st.cache_resource
 def load_image_master():
+    """
+    商品管理番号（商品URL）→ 商品画像パス1 のSeriesを返す。
+    プロセス内で1つのオブジェクトを共有するので、呼び出し側では書き換えないこと。
+    """
     folder = "商品画像URLマスタ"
     paths = glob.glob(os.path.join(folder, "*.csv"))
 
     if not paths:
-        return {}
+        return pd.Series(dtype="string")
+
+    tables = [read_table_cached(p, _read_image_master_csv, "image_master_v3") for p in paths]
+    merged = pa.concat_tables(tables)
+    if merged.num_rows == 0:
+        return pd.Series(dtype="string")
+
+    # 前後の空白除去はArrowのまま1回で行い、pandasへの変換は最後だけ
+    keys = pc.utf8_trim_whitespace(merged.column("商品管理番号（商品URL）")).to_pandas()
+    img_series = pd.Series(
+        pc.utf8_trim_whitespace(merged.column("商品画像パス1")).to_pandas().to_numpy(),
+        index=keys.to_numpy(),
+        dtype="string",
+    )
+    # 同じ商品管理番号が複数ファイルにある場合は後勝ち（dict化していた頃と同じ挙動）
+    return img_series[~img_series.index.duplicated(keep="last")]
 
-    dfs = []
-    for p in paths:
-        df = pd.read_csv(p, encoding="cp932")
-        if "商品管理番号（商品URL）" in df.columns and "商品画像パス1" in df.columns:
-            dfs.append(df[["商品管理番号（商品URL）", "商品画像パス1"]])
 
-    if not dfs:
-        return {}
+IMAGE_BASE_URL = "https://image.rakuten.co.jp/hype/cabinet"
+
+
+@st.cache_resource
+def load_image_url_master():
+    """
+    商品管理番号（商品URL）→ 画像URL（ベースURLを付けた完全なURL、画像が無ければ空文字）のSeriesを返す。
+    URLの組み立てはマスタ1件につき1回だけ行い、表示のたびには商品基本コードで引くだけにする。
+    プロセス内で1つのオブジェクトを共有するので、呼び出し側では書き換えないこと。
+    """
+    rel = load_image_master().fillna("")
+    # マスタに完全なURL（http〜）が入っている場合はベースURLを付けずにそのまま使う
+    urls = (IMAGE_BASE_URL + rel).where(~rel.str.startswith("http"), rel)
+    return urls.where(rel != "", "")
 
-    merged = pd.concat(dfs, ignore_index=True)
-    merged["商品管理番号（商品URL）"] = merged["商品管理番号（商品URL）"].astype(str).str.strip()
-    merged["商品画像パス1"] = merged["商品画像パス1"].astype(str).str.strip()
 
-    return dict(zip(merged["商品管理番号（商品URL）"], merged["商品画像パス1"]))
+def build_image_urls(codes, url_master):
+    """
+    商品基本コードのSeriesから画像URLマスタ（load_image_url_master）を引き、画像URLのSeriesを返す（マスタに無ければ空文字）。
+    同じ商品基本コードは複数SKUで繰り返し出てくるため、ユニークなコードごとに1回だけ引いて全行へmapする。
+    """
+    keys = codes.astype(str).str.strip()
+    uniq = keys.drop_duplicates()
+    url_by_key = pd.Series(
+        uniq.map(url_master).fillna("").to_numpy(dtype=object), index=uniq.to_numpy()
+    )
+    return keys.map(url_by_key)
 
 
 # ==========================
@@ -104,8 +318,8 @@ def load_sku_master():
     merged = merged.drop_duplicates(subset=["CS品番"], keep="last")
 
     return [
-        {"cs_no": row["CS品番"], "sku": row["SKU"]}
-        for _, row in merged.iterrows()
+        {"cs_no": cs_no, "sku": sku}
+        for cs_no, sku in zip(merged["CS品番"].tolist(), merged["SKU"].tolist())
     ]
 
 
@@ -113,79 +327,97 @@ def load_sku_master():
 # テンポスター現在庫マップ（商品コード＝SKU → 現在庫）
 # ==========================
 @st.cache_data
-def get_tempostar_stock_map(file_paths):
+def get_tempostar_stock_map(file_keys):
     """
     全期間のTempostar CSVから、商品コードごとの最新の「変動後」在庫数を計算する。
     （フィルター期間に関わらず、常に最新の在庫を反映するため全ファイルを対象にする）
+    file_keys は tempostar_file_keys の戻り値（更新日時・サイズ込みなので、CSVが差し替えられたら計算し直す）。
     """
-    if not file_paths:
+    if not file_keys:
         return {}
 
-    df_all = load_tempostar_data(tuple(sorted(file_paths)))
+    df_all = _load_tempostar_data(file_keys)
 
     if "商品コード" not in df_all.columns or "変動後" not in df_all.columns:
         return {}
 
-    df_all = df_all.copy()
-    df_all["商品コード"] = df_all["商品コード"].astype(str).str.strip()
-
-    # ファイル名の日付順に並べ替えてから、SKUごとに最後の値（＝最新在庫）を取る
-    df_all["_日付"] = df_all["元ファイル"].astype(str).str.extract(r"(\d{8})")
-    df_all = df_all.sort_values("_日付")
-
-    stock = (
-        df_all.groupby("商品コード", dropna=False)["変動後"]
-        .last()
-        .to_dict()
-    )
-    return {k: int(v) for k, v in stock.items()}
+    # ファイル名（tempostar_stock_YYYYMMDD.csv）順に読み込んでいるので、行はすでに日付順・ファイル内の記録順に並んでいる。
+    # 並べ替えやgroupbyをせず、SKUごとに最後に出てきた行（＝最新在庫）を残すだけでよい
+    latest = df_all[["商品コード", "変動後"]].drop_duplicates("商品コード", keep="last")
+    return {str(k): int(v) for k, v in zip(latest["商品コード"], latest["変動後"])}
 
 
 # ==========================
 # テンポスター日別売上マップ（SKU → [{d:'YYYYMMDD', q:数量}, ...]）
 # ==========================
+def _factorize_by_level(series, transform):
+    """
+    Seriesを transform（文字列化・抽出など）した値で、ソート済みのユニーク値（object型ndarray）と
+    行ごとの番号（欠損は -1）に分解する。
+    カテゴリ列は transform をカテゴリ（ユニーク値）側だけに行い、codesで全行に展開する。
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        # 欠損（code = -1）は transform 前の値を NaN として末尾に置き、level_codes[-1] で引く
+        levels = pd.Series(list(series.cat.categories) + [np.nan], dtype=object)
+        level_codes, uniques = pd.factorize(transform(levels), sort=True)
+        codes = level_codes[series.cat.codes.to_numpy()]
+    else:
+        codes, uniques = pd.factorize(transform(series), sort=True)
+    return codes, np.asarray(uniques, dtype=object)
+
+
 @st.cache_data
-def get_tempostar_sales_map(file_paths):
+def get_tempostar_sales_map(file_keys):
     """
     全期間のTempostar CSVから、商品コード（SKU）×日付ごとの売上個数を集計する。
     納品推奨数システム側で任意の期間を選んで自社売上個数を合算できるようにするため、
     日別の時系列データとして返す。
+    file_keys は tempostar_file_keys の戻り値（更新日時・サイズ込みなので、CSVが差し替えられたら計算し直す）。
     """
-    if not file_paths:
+    if not file_keys:
         return {}
 
-    df_all = load_tempostar_data(tuple(sorted(file_paths)))
+    df_all = _load_tempostar_data(file_keys)
 
     required = {"商品コード", "増減値"}
     if not required.issubset(df_all.columns):
         return {}
 
-    df_all = df_all.copy()
-    df_all["商品コード"] = df_all["商品コード"].astype(str).str.strip()
-    df_all["_日付"] = df_all["元ファイル"].astype(str).str.extract(r"(\d{8})")
-
-    if "更新理由" in df_all.columns:
-        df_sales = df_all[df_all["更新理由"].astype(str).str.contains("受注取込", na=False)].copy()
-    else:
-        df_sales = df_all.copy()
-
-    df_sales["売上個数"] = -df_sales["増減値"]
-    df_sales = df_sales[df_sales["売上個数"] > 0]
+    df_sales = df_all[_sales_row_mask(df_all)]
+    qty = -df_sales["増減値"].to_numpy(dtype=np.int64)
+    df_sales = df_sales[qty > 0]
+    qty = qty[qty > 0]
 
-    grouped = (
-        df_sales.groupby(["商品コード", "_日付"], dropna=False)["売上個数"]
-        .sum()
-        .reset_index()
+    # SKU・日付をソート済みの番号にし、groupby＋行ごとのループの代わりに
+    # 「SKU番号×日付数＋日付番号」の整数キーを並べ替えて、キーの切れ目ごとに np.add.reduceat で合計する
+    sku_codes, skus = _factorize_by_level(
+        df_sales["商品コード"], lambda s: s.astype(str).str.strip()
+    )
+    date_codes, dates = _factorize_by_level(
+        df_sales["元ファイル"], lambda s: s.astype(str).str.extract(r"(\d{8})", expand=False)
     )
 
-    sales_map = {}
-    for sku, sub in grouped.groupby("商品コード"):
-        sub = sub.sort_values("_日付")
-        sales_map[sku] = [
-            {"d": row["_日付"], "q": int(row["売上個数"])}
-            for _, row in sub.iterrows()
-            if pd.notna(row["_日付"])
-        ]
+    # 商品コードが欠損の行は除く。日付の取れない行は日別データに入れないが、SKU自体は（空のリストで）残す
+    has_sku = sku_codes >= 0
+    sales_map = {sku: [] for sku in skus[np.unique(sku_codes[has_sku])].tolist()}
+
+    has_date = has_sku & (date_codes >= 0)
+    keys = sku_codes[has_date].astype(np.int64) * len(dates) + date_codes[has_date]
+    if len(keys) == 0:
+        return sales_map
+
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    sums = np.add.reduceat(qty[has_date][order], starts)
+    group_keys = sorted_keys[starts]
+
+    for sku, d, q in zip(
+        skus[group_keys // len(dates)].tolist(),
+        dates[group_keys % len(dates)].tolist(),
+        sums.tolist(),
+    ):
+        sales_map[sku].append({"d": d, "q": q})
     return sales_map
 
 
@@ -242,15 +474,16 @@ RAKUTEN_RETRY_BASE_WAIT = 2.0  # リトライ時の待機秒数の基準（指
 
 
 @st.cache_data
-def get_rakuten_sku_pairs(file_paths):
+def get_rakuten_sku_pairs(file_keys):
     """
     Tempostar CSV全体から (商品基本コード=manageNumber, 商品コード=variantId) の
     重複なしペア一覧を作る。楽天APIへ問い合わせる対象リストとして使う。
+    file_keys は tempostar_file_keys の戻り値（更新日時・サイズ込みなので、CSVが差し替えられたら計算し直す）。
     """
-    if not file_paths:
+    if not file_keys:
         return tuple()
 
-    df_all = load_tempostar_data(tuple(sorted(file_paths)))
+    df_all = _load_tempostar_data(file_keys)
     required = {"商品コード", "商品基本コード"}
     if not required.issubset(df_all.columns):
         return tuple()
@@ -263,7 +496,7 @@ def get_rakuten_sku_pairs(file_paths):
     )
     pairs = pairs[(pairs["商品基本コード"] != "") & (pairs["商品コード"] != "")]
     return tuple(
-        (row["商品基本コード"], row["商品コード"]) for _, row in pairs.iterrows()
+        zip(pairs["商品基本コード"].tolist(), pairs["商品コード"].tolist())
     )
 
 
@@ -432,11 +665,14 @@ AMAZON_TTL_SECONDS = 20 * 60 * 60  # 20時間
 
 
 @st.cache_data
-def get_amazon_sku_list(file_paths):
-    """Tempostar CSV全体から商品コード（＝Amazon出品者SKU）の重複なし一覧を作る。"""
-    if not file_paths:
+def get_amazon_sku_list(file_keys):
+    """
+    Tempostar CSV全体から商品コード（＝Amazon出品者SKU）の重複なし一覧を作る。
+    file_keys は tempostar_file_keys の戻り値（更新日時・サイズ込みなので、CSVが差し替えられたら計算し直す）。
+    """
+    if not file_keys:
         return tuple()
-    df_all = load_tempostar_data(tuple(sorted(file_paths)))
+    df_all = _load_tempostar_data(file_keys)
     if "商品コード" not in df_all.columns:
         return tuple()
     skus = df_all["商品コード"].astype(str).str.strip()
@@ -651,46 +887,148 @@ def render_amazon_refresh_control(fetched_at, fetching, errors, key):
 
 
 # ==========================
-# HTML テーブル生成（商品コードクリック対応）
+# キーワード絞り込み（商品コード / 商品基本コード / 商品名）
 # ==========================
-def make_html_table(df: pd.DataFrame) -> str:
-    thead = "<thead><tr>" + "".join(
-        f"<th>{html.escape(str(c))}</th>" for c in df.columns
-    ) + "</tr></thead>"
-
-    body_rows = []
-    for _, row in df.iterrows():
-        tds = []
-        for col in df.columns:
-            val = row[col]
-
-            if col == "商品コード":
-                code = html.escape(str(val))
-                # ★同じタブで開く（新規タブにならないように）
-                link = (
-                    f"<a href='?sku={code}' target='_self' "
-                    f"style='color:#0073e6; text-decoration:none;'>{code}</a>"
-                )
-                tds.append(f"<td>{link}</td>")
+KEYWORD_SEARCH_COLUMNS = ["商品コード", "商品基本コード", "商品名"]
+
 
-            elif col == "画像":
-                tds.append(f"<td>{val}</td>")
+def _contains_mask(series, needle):
+    """
+    Seriesの各値（文字列化して小文字にしたもの）に needle（小文字化済み）が含まれるかのbool ndarrayを返す。
+    カテゴリ列は文字列化・検索をカテゴリ（ユニーク値）側で1回だけ行い、codesで全行に展開する。
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        levels = series.cat.categories.astype(str).str.lower()
+        hit = np.asarray(levels.str.contains(needle, regex=False), dtype=bool)
+        # 欠損（code = -1）は従来の astype(str) と同じく "nan" として判定し、末尾に置いて hit[-1] で引く
+        hit = np.append(hit, needle in "nan")
+        return hit[series.cat.codes.to_numpy()]
+    return series.astype(str).str.lower().str.contains(needle, regex=False, na=False).to_numpy()
 
-            # ★HTMLをそのまま表示する列（ここに「現在庫」も追加）
-            elif col in ["発注推奨数", "指定日売上個数(昨年売上個数)", "現在庫"]:
-                tds.append(f"<td>{val}</td>")
 
-            else:
-                tds.append(f"<td>{html.escape(str(val))}</td>")
+def filter_by_keyword(df, keyword):
+    """
+    いずれかの検索対象列にキーワードを含む行だけを返す（大文字・小文字は区別しない）。
+    キーワードは正規表現ではなく文字列としてそのまま検索する。
+    """
+    if not keyword:
+        return df
+
+    # 正規表現は使わず単純な部分一致で判定し、列ごとの判定結果はndarrayのまま1回でORする
+    needle = keyword.lower()
+    masks = [
+        _contains_mask(df[col], needle)
+        for col in KEYWORD_SEARCH_COLUMNS
+        if col in df.columns
+    ]
+    if not masks:
+        return df.iloc[0:0]
+    return df[np.logical_or.reduce(masks)]
 
-        body_rows.append("<tr>" + "".join(tds) + "</tr>")
 
-    return f"""
-    <table class="sku-table">
-      {thead}
-      <tbody>{"".join(body_rows)}</tbody>
-    </table>
+# ==========================
+# SKU別集計（売上個数合計＋現在庫）
+# ==========================
+SKU_INFO_COLUMNS = ["商品基本コード", "商品名", "属性1名", "属性2名"]
+
+
+def aggregate_sales_and_stock(df, is_sales):
     """
+    商品コードごとに、売上行（is_sales）の売上個数合計（＝増減値合計の符号反転）・商品情報と、
+    全行での最後の「変動後」（＝現在庫）を1回のgroupbyでまとめて集計する。
+    売上個数合計が0以下のSKUは除く。
+    """
+    # 売上行以外は増減値を0、商品情報を欠損にしておくことで、
+    # 売上行だけのsum / last（欠損は読み飛ばす）と同じ結果を全行の1パスで得る
+    columns = {"商品コード": df["商品コード"]}
+    agg = {}
+    for col in SKU_INFO_COLUMNS:
+        columns[col] = df[col].where(is_sales)
+        agg[col] = "last"
+    # 売上は増減値のマイナス分なので、明細の段階で符号を反転しておき、集計後の列の作り直しを省く
+    columns["売上個数合計"] = -df["増減値"].where(is_sales, 0)
+    agg["売上個数合計"] = "sum"
+    if "変動後" in df.columns:
+        columns["変動後"] = df["変動後"]
+        agg["変動後"] = "last"
+    work = pd.DataFrame(columns)
+
+    grouped = (
+        work.groupby("商品コード", dropna=False, observed=True)
+        .agg(agg)
+        .reset_index()
+        .rename(columns={"変動後": "現在庫"})
+    )
+    if "現在庫" in grouped.columns:
+        # 変動後は読み込み時に欠損を0で埋めた整数列なので、lastの結果も欠損なしの整数（数値変換は不要）
+        grouped["現在庫"] = grouped["現在庫"].astype(int)
+    else:
+        grouped["現在庫"] = 0
+
+    grouped = grouped[grouped["売上個数合計"] > 0]
+    # 読み込み時のカテゴリ型は期間内の全SKU分のカテゴリを持ったままなので、そのまま st.dataframe に渡すと
+    # ブラウザへ送るデータが表示行数に関係なく大きくなる。集計後の小さな表では通常の文字列（欠損はそのまま）に戻す
+    return grouped.astype({
+        col: object
+        for col in ["商品コード", *SKU_INFO_COLUMNS]
+        if isinstance(grouped[col].dtype, pd.CategoricalDtype)
+    })
+
+
+def _sales_row_mask(df, exact_reason=False):
+    """
+    売上行のbool ndarrayを返す。更新理由列が無ければ全行を売上とみなす。
+    通常は更新理由に「受注取込」を含む行、exact_reason=True なら更新理由が「受注取込」と完全一致する行を売上とする
+    （発注目安タブは従来どおり完全一致で判定する）。
+    """
+    if "更新理由" not in df.columns:
+        return np.ones(len(df), dtype=bool)
+    if exact_reason:
+        return (df["更新理由"] == "受注取込").to_numpy(dtype=bool)
+    return _contains_mask(df["更新理由"], "受注取込")
+
+
+@st.cache_data(show_spinner=False)
+def aggregate_period_sales(file_keys, keyword, exact_reason=False):
+    """
+    指定CSV（file_keys は tempostar_file_keys の戻り値）をキーワードで絞り込み、
+    SKU別の売上個数合計・商品情報・現在庫を集計して返す。キーワードに一致する行が無ければ None を返す。
+    売上行の判定（exact_reason）は _sales_row_mask と同じ。
+    楽天・Amazon在庫や画像URLの付与は再実行ごとに変わりうるので呼び出し側で行い、
+    ここは期間とキーワードが同じ再実行（行選択・在庫取得待ちの再描画など）では集計をやり直さない。
+    キーに更新日時・サイズを含めるので、CSVが差し替えられたら集計し直す。
+    """
+    df = filter_by_keyword(_load_tempostar_data(file_keys), keyword)
+    if df.empty:
+        return None
+    return aggregate_sales_and_stock(df, _sales_row_mask(df, exact_reason))
+
+
+@st.cache_data(show_spinner=False)
+def sum_sales_by_sku(file_keys, keyword):
+    """
+    指定CSV（file_keys は tempostar_file_keys の戻り値）をキーワードで絞り込み、
+    商品コードごとの売上個数（売上行の増減値合計の符号反転）を返す。
+    """
+    df = filter_by_keyword(_load_tempostar_data(file_keys), keyword)
+    df_sales = df[_sales_row_mask(df)]
+    return -df_sales.groupby("商品コード", dropna=False, observed=True)["増減値"].sum()
+
+
+def attach_sku_lookup_columns(df, rakuten_stock_map, amazon_stock_map, forecast_map):
+    """
+    SKU別集計に「楽天在庫」「Amazon FBA在庫」「売上個数予想」列を付けて返す。
+    3つとも商品コードをキーにした辞書引きなので、商品コードの文字列化・strip は1回だけ行う。
+    """
+    sku = df["商品コード"].astype(str).str.strip()
+    return df.assign(**{
+        # 楽天在庫（RMS 在庫API 2.0・リアルタイム取得）
+        "楽天在庫": sku.map(rakuten_stock_map),
+        # Amazon FBA在庫（出荷可能数量・SP-APIより取得）。行ごとにlambdaを呼ばず、SKU→出荷可能数 の辞書でmapする
+        "Amazon FBA在庫": sku.map({k: v.get("fulfillable") for k, v in amazon_stock_map.items()}),
+        # 売上個数予想（去年翌日を起点にした期間集計）
+        "売上個数予想": sku.map(forecast_map).fillna(0).astype(int),
+    })
 
 
 # ==========================
@@ -703,9 +1041,14 @@ def show_stock_drawer(selected_sku: str, df_main: pd.DataFrame):
     if "変動後" not in df_main.columns:
         msg = "『変動後』列がないため在庫推移グラフを表示できません。"
     else:
-        df_sku = df_main[df_main["商品コード"] == selected_sku].copy()
-        df_sku["日付"] = df_sku["元ファイル"].astype(str).str.extract(r"(\d{8})")
-        df_sku["日付"] = pd.to_datetime(df_sku["日付"], format="%Y%m%d", errors="coerce")
+        df_sku = df_main[df_main["商品コード"] == selected_sku]
+        df_sku = df_sku.assign(
+            日付=pd.to_datetime(
+                df_sku["元ファイル"].astype(str).str.extract(r"(\d{8})", expand=False),
+                format="%Y%m%d",
+                errors="coerce",
+            )
+        )
         df_plot = df_sku[["日付", "変動後"]].dropna().sort_values("日付")
 
         if df_plot.empty:
@@ -797,119 +1140,9 @@ def show_stock_drawer(selected_sku: str, df_main: pd.DataFrame):
 
 
 # ==========================
-# Main
+# 画面共通CSS
 # ==========================
-def main():
-    st.set_page_config(page_title="Tempostar 売上集計", layout="wide")
-    st.title("Tempostar 在庫変動データ")
-
-    # ---------- CSV 一覧 ----------
-    raw_paths = sorted(glob.glob("tempostar_stock_*.csv"))
-    if not raw_paths:
-        st.error("tempostar_stock_*.csv がありません。")
-        return
-
-    file_infos = []
-    pat = re.compile(r"tempostar_stock_(\d{8})")
-
-    for path in raw_paths:
-        name = os.path.basename(path)
-        m = pat.search(name)
-        if m:
-            d = datetime.strptime(m.group(1), "%Y%m%d").date()
-            file_infos.append({"date": d, "path": path, "name": name})
-
-    if not file_infos:
-        st.error("tempostar_stock_YYYYMMDD.csv 形式のファイルがありません。")
-        return
-
-    all_dates = sorted({fi["date"] for fi in file_infos})
-    min_date, max_date = min(all_dates), max(all_dates)
-
-    if "selected_sku" not in st.session_state:
-        st.session_state["selected_sku"] = None
-
-    # ---------- 楽天在庫（RMS 在庫API 2.0・非ブロッキング背景取得） ----------
-    # 自動取得は「このブラウザセッションでまだ取得していない時（＝開いた直後やF5直後）」のみ。
-    # それ以外は手動更新ボタンを押さない限り、取得済みの値をそのまま使い続ける。
-    all_paths_for_rakuten = tuple(sorted(fi["path"] for fi in file_infos))
-    manual_refresh = st.session_state.pop("rakuten_force_refresh", False)
-    need_session_fetch = not st.session_state.get("rakuten_session_fetched", False)
-    st.session_state["rakuten_session_fetched"] = True
-
-    if _rakuten_auth_header() is None:
-        rakuten_stock_map, rakuten_errors, rakuten_fetched_at, rakuten_fetching = {}, [], None, False
-    else:
-        rakuten_pairs = get_rakuten_sku_pairs(all_paths_for_rakuten)
-        rakuten_stock_map, rakuten_errors, rakuten_fetched_at, rakuten_fetching = get_rakuten_stock_state(
-            rakuten_pairs, force=(manual_refresh or need_session_fetch)
-        )
-
-    # ---------- Amazon FBA在庫（SP-API・非ブロッキング背景取得） ----------
-    # Amazon推奨（1日1回程度）に沿って、自動更新は約20時間おき。手動更新ボタンはいつでも押せる。
-    amazon_manual_refresh = st.session_state.pop("amazon_force_refresh", False)
-    if _amazon_credentials() is None:
-        amazon_stock_map, amazon_errors, amazon_fetched_at, amazon_fetching = {}, [], None, False
-    else:
-        amazon_skus = get_amazon_sku_list(all_paths_for_rakuten)
-        amazon_stock_map, amazon_errors, amazon_fetched_at, amazon_fetching = get_amazon_fba_stock_state(
-            amazon_skus, force=amazon_manual_refresh
-        )
-
-
-    # ---------- 売上個数予想用：全期間の日別売上マップ（1回だけ計算） ----------
-    all_sales_map = get_tempostar_sales_map(all_paths_for_rakuten)
-
-    # ---------- 初期フィルタ（セッション） ----------
-    default_forecast_start, default_forecast_end = default_forecast_range()
-
-    default_start = max_date - timedelta(days=30)
-    if default_start < min_date:
-        default_start = min_date
-
-    # フィルター入力値を session_state のフラットなキーで管理
-    # （st.form 内で key= に渡すことで value= の上書き問題を回避）
-    if "sku_applied" not in st.session_state:
-        st.session_state["sku_applied"] = False
-    if "restock_applied" not in st.session_state:
-        st.session_state["restock_applied"] = True
-
-    # 売上個数タブ用デフォルト
-    if "sku_keyword" not in st.session_state:
-        st.session_state["sku_keyword"] = ""
-    if "sku_start_date" not in st.session_state:
-        st.session_state["sku_start_date"] = default_start
-    if "sku_end_date" not in st.session_state:
-        st.session_state["sku_end_date"] = max_date
-    if "sku_min_sales" not in st.session_state:
-        st.session_state["sku_min_sales"] = 0
-    if "sku_forecast_start" not in st.session_state:
-        st.session_state["sku_forecast_start"] = default_forecast_start
-    if "sku_forecast_end" not in st.session_state:
-        st.session_state["sku_forecast_end"] = default_forecast_end
-
-    # 発注推奨タブ用デフォルト
-    if "rs_keyword" not in st.session_state:
-        st.session_state["rs_keyword"] = ""
-    if "rs_min_sales" not in st.session_state:
-        st.session_state["rs_min_sales"] = 0
-    if "rs_months" not in st.session_state:
-        st.session_state["rs_months"] = 1
-    if "rs_target_days" not in st.session_state:
-        st.session_state["rs_target_days"] = 30
-    if "rs_max_stock" not in st.session_state:
-        st.session_state["rs_max_stock"] = 999999
-    if "rs_forecast_start" not in st.session_state:
-        st.session_state["rs_forecast_start"] = default_forecast_start
-    if "rs_forecast_end" not in st.session_state:
-        st.session_state["rs_forecast_end"] = default_forecast_end
-
-
-    # ==========================
-    # CSS
-    # ==========================
-    st.markdown(
-        """
+APP_CSS = """
 <style>
 /* ===== ページ全体 ===== */
 [data-testid="stAppViewContainer"] { background: #f7f8fa; }
@@ -1061,9 +1294,154 @@ def main():
 }
 .metric-chip strong { color: #1a1d23; font-size: 16px; margin-left: 4px; }
 </style>
-""",
-        unsafe_allow_html=True,
-    )
+"""
+
+
+# ==========================
+# Tempostar CSV 一覧
+# ==========================
+@st.cache_data
+def scan_tempostar_files(dir_mtime):
+    """
+    カレントフォルダの tempostar_stock_YYYYMMDD.csv を列挙する。
+    戻り値: (tempostar_stock_*.csv の件数, [{"date", "path", "name"}, ...], 日付の昇順リスト)
+    dir_mtime はキャッシュのキー用（フォルダの更新日時）。
+    """
+    prefix = "tempostar_stock_"
+    # glob（パターン照合）ではなく scandir で名前だけを見て絞り込む
+    with os.scandir(".") as it:
+        raw_paths = sorted(
+            e.name for e in it
+            if e.name.startswith(prefix) and e.name.endswith(".csv") and e.is_file()
+        )
+
+    file_infos = []
+    for name in raw_paths:
+        # 日付部分（プレフィックス直後の8桁）は正規表現を使わずに切り出す
+        ymd = name[len(prefix):len(prefix) + 8]
+        if len(ymd) == 8 and ymd.isascii() and ymd.isdigit():
+            d = datetime.strptime(ymd, "%Y%m%d").date()
+            file_infos.append({"date": d, "path": name, "name": name})
+
+    all_dates = sorted({fi["date"] for fi in file_infos})
+    return len(raw_paths), file_infos, all_dates
+
+
+def select_files_in_range(file_infos, start, end):
+    """
+    file_infos から日付が start ～ end（両端含む）のものを返す。
+    file_infos はファイル名（＝日付）の昇順に並んでいるので、全件を見ずに二分探索で範囲を切り出す。
+    """
+    lo = bisect.bisect_left(file_infos, start, key=lambda fi: fi["date"])
+    hi = bisect.bisect_right(file_infos, end, key=lambda fi: fi["date"])
+    return file_infos[lo:hi]
+
+
+# ==========================
+# Main
+# ==========================
+def main():
+    st.set_page_config(page_title="Tempostar 売上集計", layout="wide")
+    st.title("Tempostar 在庫変動データ")
+
+    # ---------- CSV 一覧 ----------
+    # フォルダの更新日時（ファイルの追加・削除で変わる）をキーにして、一覧と日付範囲の計算は変化があった時だけ行う
+    raw_count, file_infos, all_dates = scan_tempostar_files(os.stat(".").st_mtime)
+    if not raw_count:
+        st.error("tempostar_stock_*.csv がありません。")
+        return
+
+    if not file_infos:
+        st.error("tempostar_stock_YYYYMMDD.csv 形式のファイルがありません。")
+        return
+
+    min_date, max_date = all_dates[0], all_dates[-1]
+
+    if "selected_sku" not in st.session_state:
+        st.session_state["selected_sku"] = None
+
+    # ---------- 楽天在庫（RMS 在庫API 2.0・非ブロッキング背景取得） ----------
+    # 自動取得は「このブラウザセッションでまだ取得していない時（＝開いた直後やF5直後）」のみ。
+    # それ以外は手動更新ボタンを押さない限り、取得済みの値をそのまま使い続ける。
+    all_paths_for_rakuten = tuple(sorted(fi["path"] for fi in file_infos))
+    # 全期間CSVのキャッシュキー（更新日時・サイズ込み。CSVが差し替えられたら各集計を作り直す）
+    all_file_keys = tempostar_file_keys(all_paths_for_rakuten)
+    manual_refresh = st.session_state.pop("rakuten_force_refresh", False)
+    need_session_fetch = not st.session_state.get("rakuten_session_fetched", False)
+    st.session_state["rakuten_session_fetched"] = True
+
+    if _rakuten_auth_header() is None:
+        rakuten_stock_map, rakuten_errors, rakuten_fetched_at, rakuten_fetching = {}, [], None, False
+    else:
+        rakuten_pairs = get_rakuten_sku_pairs(all_file_keys)
+        rakuten_stock_map, rakuten_errors, rakuten_fetched_at, rakuten_fetching = get_rakuten_stock_state(
+            rakuten_pairs, force=(manual_refresh or need_session_fetch)
+        )
+
+    # ---------- Amazon FBA在庫（SP-API・非ブロッキング背景取得） ----------
+    # Amazon推奨（1日1回程度）に沿って、自動更新は約20時間おき。手動更新ボタンはいつでも押せる。
+    amazon_manual_refresh = st.session_state.pop("amazon_force_refresh", False)
+    if _amazon_credentials() is None:
+        amazon_stock_map, amazon_errors, amazon_fetched_at, amazon_fetching = {}, [], None, False
+    else:
+        amazon_skus = get_amazon_sku_list(all_file_keys)
+        amazon_stock_map, amazon_errors, amazon_fetched_at, amazon_fetching = get_amazon_fba_stock_state(
+            amazon_skus, force=amazon_manual_refresh
+        )
+
+
+    # ---------- 売上個数予想用：全期間の日別売上マップ（1回だけ計算） ----------
+    all_sales_map = get_tempostar_sales_map(all_file_keys)
+
+    # ---------- 初期フィルタ（セッション） ----------
+    default_forecast_start, default_forecast_end = default_forecast_range()
+
+    default_start = max_date - timedelta(days=30)
+    if default_start < min_date:
+        default_start = min_date
+
+    # フィルター入力値を session_state のフラットなキーで管理
+    # （st.form 内で key= に渡すことで value= の上書き問題を回避）
+    if "sku_applied" not in st.session_state:
+        st.session_state["sku_applied"] = False
+    if "restock_applied" not in st.session_state:
+        st.session_state["restock_applied"] = True
+
+    # 売上個数タブ用デフォルト
+    if "sku_keyword" not in st.session_state:
+        st.session_state["sku_keyword"] = ""
+    if "sku_start_date" not in st.session_state:
+        st.session_state["sku_start_date"] = default_start
+    if "sku_end_date" not in st.session_state:
+        st.session_state["sku_end_date"] = max_date
+    if "sku_min_sales" not in st.session_state:
+        st.session_state["sku_min_sales"] = 0
+    if "sku_forecast_start" not in st.session_state:
+        st.session_state["sku_forecast_start"] = default_forecast_start
+    if "sku_forecast_end" not in st.session_state:
+        st.session_state["sku_forecast_end"] = default_forecast_end
+
+    # 発注推奨タブ用デフォルト
+    if "rs_keyword" not in st.session_state:
+        st.session_state["rs_keyword"] = ""
+    if "rs_min_sales" not in st.session_state:
+        st.session_state["rs_min_sales"] = 0
+    if "rs_months" not in st.session_state:
+        st.session_state["rs_months"] = 1
+    if "rs_target_days" not in st.session_state:
+        st.session_state["rs_target_days"] = 30
+    if "rs_max_stock" not in st.session_state:
+        st.session_state["rs_max_stock"] = 999999
+    if "rs_forecast_start" not in st.session_state:
+        st.session_state["rs_forecast_start"] = default_forecast_start
+    if "rs_forecast_end" not in st.session_state:
+        st.session_state["rs_forecast_end"] = default_forecast_end
+
+
+    # ==========================
+    # CSS（文字列はモジュール定数。要素は実行のたびに描き直されるので出力は毎回行う）
+    # ==========================
+    st.markdown(APP_CSS, unsafe_allow_html=True)
 
         # ==========================
     # タブ（タブ名と中身を一致させる）
@@ -1151,97 +1529,31 @@ def main():
                 if start_r < min_date:
                     start_r = min_date
 
-                restock_files = [fi for fi in file_infos if start_r <= fi["date"] <= end_r]
+                restock_files = select_files_in_range(file_infos, start_r, end_r)
                 if not restock_files:
                     st.warning(f"直近{restock_months}ヶ月（{start_r} ～ {end_r}）にCSVがありません。")
                 else:
-                    restock_paths = [fi["path"] for fi in restock_files]
-                    df_restock = load_tempostar_data(restock_paths)
-
-                    if keyword_r:
-                        cond_r = False
-                        for col in ["商品コード", "商品基本コード", "商品名"]:
-                            if col in df_restock.columns:
-                                cond_r |= df_restock[col].astype(str).str.contains(keyword_r, case=False, na=False)
-                        df_restock = df_restock[cond_r]
-
-                    if "更新理由" in df_restock.columns:
-                        df_sales_recent = df_restock[df_restock["更新理由"] == "受注取込"].copy()
-                    else:
-                        df_sales_recent = df_restock.copy()
+                    restock_paths = tuple(fi["path"] for fi in restock_files)
+                    sales_recent = aggregate_period_sales(
+                        tempostar_file_keys(restock_paths), keyword_r, exact_reason=True
+                    )
 
-                    if df_sales_recent.empty:
+                    if sales_recent is None:
+                        # キーワードに一致する行が無ければ、在庫付与・画像URL作成などは行わない
+                        st.info("条件に一致する商品がありません。")
+                    elif sales_recent.empty:
                         st.warning(f"直近{restock_months}ヶ月（{start_r} ～ {end_r}）に売上データがありません。")
                     else:
-                        agg_sales = {
-                            "商品基本コード": "last",
-                            "商品名": "last",
-                            "属性1名": "last",
-                            "属性2名": "last",
-                            "増減値": "sum",
-                        }
-
-                        sales_recent = (
-                            df_sales_recent.groupby("商品コード", dropna=False)
-                            .agg(agg_sales)
-                            .reset_index()
-                            .rename(columns={"増減値": "増減値合計"})
-                        )
-                        sales_recent["売上個数合計"] = -sales_recent["増減値合計"]
-                        sales_recent = sales_recent[sales_recent["売上個数合計"] > 0]
-
                         if min_total_sales_r > 0:
                             sales_recent = sales_recent[sales_recent["売上個数合計"] >= min_total_sales_r]
 
-                        if "変動後" in df_restock.columns:
-                            stock_group_r = (
-                                df_restock.groupby("商品コード", dropna=False)["変動後"]
-                                .last()
-                                .reset_index()
-                                .rename(columns={"変動後": "現在庫"})
-                            )
-                            stock_group_r["現在庫"] = (
-                                pd.to_numeric(stock_group_r["現在庫"], errors="coerce")
-                                .fillna(0)
-                                .astype(int)
-                            )
-                            sales_recent = sales_recent.merge(stock_group_r, on="商品コード", how="left")
-                        else:
-                            sales_recent["現在庫"] = 0
-
-                        sales_recent["現在庫"] = (
-                            pd.to_numeric(sales_recent["現在庫"], errors="coerce")
-                            .fillna(0)
-                            .astype(int)
-                        )
-
                         sales_recent = sales_recent[sales_recent["現在庫"] <= max_current_stock]
 
-                        # 楽天在庫（RMS 在庫API 2.0・リアルタイム取得）
-                        sales_recent["楽天在庫"] = (
-                            sales_recent["商品コード"].astype(str).str.strip().map(rakuten_stock_map)
+                        sales_recent = attach_sku_lookup_columns(
+                            sales_recent, rakuten_stock_map, amazon_stock_map, forecast_map_r
                         )
 
-                        # Amazon FBA在庫（出荷可能数量・SP-APIより取得）
-                        sales_recent["Amazon FBA在庫"] = (
-                            sales_recent["商品コード"].astype(str).str.strip()
-                            .map(lambda k: amazon_stock_map.get(k, {}).get("fulfillable"))
-                        )
-
-                        # 売上個数予想（去年翌日を起点にした期間集計）
-                        sales_recent["売上個数予想"] = (
-                            sales_recent["商品コード"].astype(str).str.strip().map(forecast_map_r).fillna(0).astype(int)
-                        )
-
-                        img_master = load_image_master()
-                        base_url = "https://image.rakuten.co.jp/hype/cabinet"
-
-                        def to_img_url(code):
-                            key = str(code).strip()
-                            rel = img_master.get(key, "")
-                            return (base_url + rel) if rel else ""
-
-                        sales_recent["画像"] = sales_recent["商品基本コード"].apply(to_img_url)
+                        sales_recent["画像"] = build_image_urls(sales_recent["商品基本コード"], load_image_url_master())
 
                         # 発注推奨数計算
                         period_days = max((end_r - start_r).days + 1, 1)
@@ -1252,8 +1564,7 @@ def main():
                         diff = (target_qty - current_stock).fillna(0)
                         sales_recent["発注推奨数"] = diff.where(diff > 0, 0).round().astype(int)
 
-                        restock_view = sales_recent[sales_recent["発注推奨数"] > 0].copy()
-                        restock_view = restock_view.sort_values("発注推奨数", ascending=False)
+                        restock_view = sales_recent[sales_recent["発注推奨数"] > 0].sort_values("発注推奨数", ascending=False)
 
                         st.info(f"発注目安：直近 {restock_months} ヶ月（{start_r} ～ {end_r}）の売上から計算 ｜ 目標在庫 {target_days} 日分")
 
@@ -1265,20 +1576,18 @@ def main():
                                 "属性1名", "属性2名", "売上個数合計", "売上個数予想", "現在庫", "楽天在庫", "Amazon FBA在庫", "発注推奨数",
                             ]
                             display_cols = [c for c in display_cols if c in restock_view.columns]
-                            df_view_r = restock_view[display_cols].copy()
-
-                            # 在庫ステータス列を追加
-                            stock_num = pd.to_numeric(df_view_r["現在庫"], errors="coerce").fillna(0).astype(int)
-                            sales_num = pd.to_numeric(df_view_r["売上個数合計"], errors="coerce").fillna(0).astype(int)
-                            def _status(s, v):
-                                if s <= 0: return "🔴 在庫切れ"
-                                if s <= 10 or s < v: return "🟡 在庫少"
-                                return ""
-                            df_view_r.insert(
-                                df_view_r.columns.tolist().index("楽天在庫") + 1,
-                                "状態",
-                                [_status(s, v) for s, v in zip(stock_num, sales_num)]
+
+                            # 在庫ステータス列を追加（楽天在庫の右隣）し、copy/insert を挟まず1回の射影で表示用DataFrameを作る
+                            stock_num = pd.to_numeric(restock_view["現在庫"], errors="coerce").fillna(0).astype(int)
+                            sales_num = pd.to_numeric(restock_view["売上個数合計"], errors="coerce").fillna(0).astype(int)
+                            status = np.select(
+                                [stock_num <= 0, (stock_num <= 10) | (stock_num < sales_num)],
+                                ["🔴 在庫切れ", "🟡 在庫少"],
+                                default="",
                             )
+                            status_pos = display_cols.index("楽天在庫") + 1
+                            view_cols = display_cols[:status_pos] + ["状態"] + display_cols[status_pos:]
+                            df_view_r = restock_view.assign(状態=status)[view_cols]
 
                             st.markdown(
                                 f'<div class="metric-bar">'
@@ -1382,29 +1691,18 @@ def main():
                 forecast_map_s   = compute_forecast_map(all_sales_map, forecast_start_s, forecast_end_s)
 
                 # 今年ファイル
-                main_files = [fi for fi in file_infos if start_date <= fi["date"] <= end_date]
+                main_files = select_files_in_range(file_infos, start_date, end_date)
                 if not main_files:
                     st.error("選択範囲のCSVがありません。")
                     return
 
-                main_paths = [fi["path"] for fi in main_files]
+                main_paths = tuple(fi["path"] for fi in main_files)
                 df_main = load_tempostar_data(main_paths)
 
-                # SKU正規化
-                if "商品コード" in df_main.columns:
-                    df_main["商品コード"] = df_main["商品コード"].astype(str).str.strip()
-
                 # 昨年同期間ファイル
                 last_start = (pd.Timestamp(start_date) - DateOffset(years=1)).date()
                 last_end = (pd.Timestamp(end_date) - DateOffset(years=1)).date()
-                last_files = [fi for fi in file_infos if last_start <= fi["date"] <= last_end]
-
-                df_last = None
-                if last_files:
-                    last_paths = [fi["path"] for fi in last_files]
-                    df_last = load_tempostar_data(last_paths)
-                    if "商品コード" in df_last.columns:
-                        df_last["商品コード"] = df_last["商品コード"].astype(str).str.strip()
+                last_files = select_files_in_range(file_infos, last_start, last_end)
 
                 # ---- デバッグ表示 ----
                 st.caption(f"集計期間：{start_date} ～ {end_date} ｜ 昨年同期間：{last_start} ～ {last_end}")
@@ -1412,146 +1710,41 @@ def main():
                 if len(last_files) == 0:
                     st.warning("昨年同期間のCSVが見つかりません。tempostar_stock_YYYYMMDD.csv の昨年分も同じフォルダに必要です。")
 
-                # キーワード絞り込み（今年）
-                if keyword:
-                    cond = False
-                    for col in ["商品コード", "商品基本コード", "商品名"]:
-                        if col in df_main.columns:
-                            cond |= df_main[col].astype(str).str.contains(keyword, case=False, na=False)
-                    df_main = df_main[cond]
-
-                # キーワード絞り込み（昨年）
-                if df_last is not None and keyword:
-                    cond_last = False
-                    for col in ["商品コード", "商品基本コード", "商品名"]:
-                        if col in df_last.columns:
-                            cond_last |= df_last[col].astype(str).str.contains(keyword, case=False, na=False)
-                    df_last = df_last[cond_last]
-
                 required = {"商品コード", "商品基本コード", "増減値"}
                 if not required.issubset(df_main.columns):
                     st.error("Tempostar CSV に『商品コード』『商品基本コード』『増減値』が必要です。")
                     return
 
-                # --- 売上集計（今年）---
-                if "更新理由" in df_main.columns:
-                    df_sales_main = df_main[df_main["更新理由"].astype(str).str.contains("受注取込", na=False)].copy()
-                else:
-                    df_sales_main = df_main.copy()
-
-                agg_sales = {
-                    "商品基本コード": "last",
-                    "商品名": "last",
-                    "属性1名": "last",
-                    "属性2名": "last",
-                    "増減値": "sum",
-                }
-
-                sales_grouped = (
-                    df_sales_main.groupby("商品コード", dropna=False)
-                    .agg(agg_sales)
-                    .reset_index()
-                    .rename(columns={"増減値": "増減値合計"})
-                )
-                sales_grouped["売上個数合計"] = -sales_grouped["増減値合計"]
-                sales_grouped = sales_grouped[sales_grouped["売上個数合計"] > 0]
-
-                # --- 売上集計（昨年）---
-                if df_last is not None and {"商品コード", "増減値"}.issubset(df_last.columns):
-                    if "更新理由" in df_last.columns:
-                        df_sales_last = df_last[
-                            df_last["更新理由"].astype(str).str.contains("受注取込", na=False)
-                        ].copy()
-                    else:
-                        df_sales_last = df_last.copy()
-
-                    df_sales_last["商品コード"] = df_sales_last["商品コード"].astype(str).str.strip()
-                    df_sales_main["商品コード"] = df_sales_main["商品コード"].astype(str).str.strip()
-
-                    last_grouped = (
-                        df_sales_last.groupby("商品コード", dropna=False)["増減値"]
-                        .sum()
-                        .reset_index()
-                    )
-                    last_grouped["昨年売上個数"] = -last_grouped["増減値"]
-                    last_grouped = last_grouped.drop(columns=["増減値"])
-
-                    sales_grouped = sales_grouped.merge(last_grouped, on="商品コード", how="left")
-
-                sales_grouped["昨年売上個数"] = (
-                    pd.to_numeric(
-                        sales_grouped["昨年売上個数"]
-                        if "昨年売上個数" in sales_grouped.columns
-                        else pd.Series(0, index=sales_grouped.index),
-                        errors="coerce"
-                    )
-                    .fillna(0)
-                    .astype(int)
-                )
-
-                # 在庫（現在庫）
-                if "変動後" in df_main.columns:
-                    stock_group = (
-                        df_main.groupby("商品コード", dropna=False)["変動後"]
-                        .last()
-                        .reset_index()
-                        .rename(columns={"変動後": "現在庫"})
-                    )
-                    stock_group["現在庫"] = (
-                        pd.to_numeric(stock_group["現在庫"], errors="coerce")
-                        .fillna(0)
-                        .astype(int)
-                    )
-                    sales_grouped = sales_grouped.merge(stock_group, on="商品コード", how="left")
-                else:
-                    sales_grouped["現在庫"] = 0
-
-                sales_grouped["現在庫"] = (
-                    pd.to_numeric(sales_grouped["現在庫"], errors="coerce")
-                    .fillna(0)
-                    .astype(int)
-                )
-
-                # 楽天在庫（RMS 在庫API 2.0・リアルタイム取得）
-                sales_grouped["楽天在庫"] = (
-                    sales_grouped["商品コード"].astype(str).str.strip().map(rakuten_stock_map)
-                )
-
-                # Amazon FBA在庫（出荷可能数量・SP-APIより取得）
-                sales_grouped["Amazon FBA在庫"] = (
-                    sales_grouped["商品コード"].astype(str).str.strip()
-                    .map(lambda k: amazon_stock_map.get(k, {}).get("fulfillable"))
-                )
-
-                # 売上個数予想（去年翌日を起点にした期間集計）
-                sales_grouped["売上個数予想"] = (
-                    sales_grouped["商品コード"].astype(str).str.strip().map(forecast_map_s).fillna(0).astype(int)
-                )
+                # --- 売上集計（今年）＋ 在庫（現在庫）---
+                # キーワード絞り込み＋集計は期間・キーワードごとにキャッシュされる
+                sales_grouped = aggregate_period_sales(tempostar_file_keys(main_paths), keyword)
+                if sales_grouped is None or sales_grouped.empty:
+                    # 一致する行や売上のあるSKUが無ければ、昨年集計・在庫付与・画像URL作成などは行わない
+                    st.info("条件に一致する商品がありません。")
+                    return
 
                 if min_total_sales > 0:
                     sales_grouped = sales_grouped[sales_grouped["売上個数合計"] >= min_total_sales]
 
                 sales_grouped = sales_grouped.sort_values("売上個数合計", ascending=False)
 
-                # 画像列（URL形式で直接返す）
-                img_master = load_image_master()
-                base_url = "https://image.rakuten.co.jp/hype/cabinet"
-
-                def to_img_url_s(code):
-                    key = str(code).strip()
-                    rel = img_master.get(key, "")
-                    return (base_url + rel) if rel else ""
-
-                sales_grouped["画像"] = sales_grouped["商品基本コード"].apply(to_img_url_s)
-
-                # 今年・前年を別列で保持
-                sales_grouped["今年売上"] = sales_grouped["売上個数合計"].astype(int)
-                sales_grouped["前年売上"] = sales_grouped["昨年売上個数"].astype(int)
-
-                # 不要列を落とす
-                sales_grouped = sales_grouped.drop(
-                    columns=["売上個数合計", "昨年売上個数", "増減値合計",
-                             "指定日売上個数(昨年売上個数)"], errors="ignore"
+                # --- 売上集計（昨年）---
+                last_year_sales = pd.Series(0, index=sales_grouped.index)
+                if last_files:
+                    last_paths = tuple(fi["path"] for fi in last_files)
+                    if {"商品コード", "増減値"}.issubset(load_tempostar_data(last_paths).columns):
+                        # 商品コードをindexにした集計結果を map で引くだけなので、merge（キー列の結合と並べ替え）は不要
+                        last_sales = sum_sales_by_sku(tempostar_file_keys(last_paths), keyword)
+                        last_year_sales = sales_grouped["商品コード"].map(last_sales)
+
+                # 在庫・予想・画像URLは表示するSKU（件数の絞り込み後）にだけ付ける。
+                # 今年・前年の売上は表示用の列名で直接作り、集計用の列は最後の射影で落とす
+                sales_grouped = attach_sku_lookup_columns(
+                    sales_grouped, rakuten_stock_map, amazon_stock_map, forecast_map_s
+                ).assign(
+                    画像=build_image_urls(sales_grouped["商品基本コード"], load_image_url_master()),
+                    今年売上=sales_grouped["売上個数合計"].astype(int),
+                    前年売上=pd.to_numeric(last_year_sales, errors="coerce").fillna(0).astype(int),
                 )
 
                 display_cols = [
@@ -1601,7 +1794,7 @@ def main():
 
                 # 右ドロワー（選択されている時だけ）
                 if st.session_state["selected_sku"]:
-                    show_stock_drawer(st.session_state["selected_sku"], df_main)
+                    show_stock_drawer(st.session_state["selected_sku"], filter_by_keyword(df_main, keyword))
 
         # --------------------------------------------------
         # タブ2：在庫少商品（発注目安）
@@ -1621,9 +1814,9 @@ def main():
         )
 
         sku_master = load_sku_master()
-        all_paths = [fi["path"] for fi in file_infos]
-        sales_map = get_tempostar_sales_map(all_paths)
-        tempostar_stock_map = get_tempostar_stock_map(all_paths)
+        all_file_keys = tempostar_file_keys(sorted(fi["path"] for fi in file_infos))
+        sales_map = get_tempostar_sales_map(all_file_keys)
+        tempostar_stock_map = get_tempostar_stock_map(all_file_keys)
 
         if rakuten_stock_map:
             # SKUごとに楽天在庫を優先し、楽天側にデータがないSKUだけテンポスター在庫で補完する